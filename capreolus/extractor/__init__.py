@@ -5,7 +5,6 @@ from pymagnitude import Magnitude, MagnitudeUtils
 
 from capreolus.registry import ModuleBase, RegisterableModule, Dependency, CACHE_BASE_PATH
 from capreolus.utils.loginit import get_logger
-from capreolus.utils.common import padlist
 from capreolus.utils.exceptions import MissingDocError
 
 logger = get_logger(__name__)
@@ -88,9 +87,21 @@ class EmbedText(Extractor):
         self.itos = {i: s for s, i in self.stoi.items()}
         logger.info(f"vocabulary constructed, with {len(self.itos)} terms in total")
 
+        # convert each query and document to ids once here, rather than every time it is sampled in id2vec
+        qlen, doclen = self.cfg["maxqlen"], self.cfg["maxdoclen"]
+        self.qid2ids = {qid: self._tok2vec(toks, qlen) for qid, toks in self.qid2toks.items()}
+        self.qid2idfs = {qid: self._idf2vec(toks, qlen) for qid, toks in self.qid2toks.items()}
+        self.docid2ids = {docid: self._tok2ids(toks, doclen) for docid, toks in self.docid2toks.items()}
+
     def _get_idf(self, toks):
         return [self.idf.get(tok, 0) for tok in toks]
 
+    def _idf2vec(self, toks, padlen):
+        vec = np.zeros(padlen, dtype=np.float32)
+        toks = toks[:padlen]
+        vec[: len(toks)] = self._get_idf(toks)
+        return vec
+
     def _build_embedding_matrix(self):
         assert len(self.stoi) > 1  # needs more vocab than self.pad_tok
 
@@ -134,6 +145,9 @@ class EmbedText(Extractor):
         self.stoi = {self.pad_tok: self.pad}
         self.qid2toks = defaultdict(list)
         self.docid2toks = defaultdict(list)
+        self.qid2ids = {}
+        self.qid2idfs = {}
+        self.docid2ids = {}
         self.idf = defaultdict(lambda: 0)
         self.embeddings = None
         # self.cache = self.load_cache()    # TODO
@@ -142,52 +156,64 @@ class EmbedText(Extractor):
         self._build_embedding_matrix()
 
     def has_doc(self, docid):
-        return docid in self.docid2toks
+        return docid in self.docid2ids
+
+    def _tok2ids(self, toks, maxlen):
+        """ Convert the first maxlen toks to an (unpadded) array of ids """
+        toks = toks[:maxlen]
+        return np.fromiter(map(self.stoi.__getitem__, toks), dtype=np.int64, count=len(toks))
+
+    def _pad_ids(self, ids, padlen):
+        """ Copy ids into a preallocated array of length padlen (truncating or padding) """
+        vec = np.full(padlen, self.pad, dtype=np.int64)
+        ids = ids[:padlen]
+        vec[: len(ids)] = ids
+        return vec
 
-    def _tok2vec(self, toks):
-        return [self.stoi[tok] for tok in toks]
+    def _tok2vec(self, toks, padlen):
+        return self._pad_ids(self._tok2ids(toks, padlen), padlen)
 
     def id2vec(self, qid, posid, negid=None, query=None):
+        # TODO find a way to calculate qlen/doclen stats earlier, so we can log them and check sanity of our values
+        qlen, doclen = self.cfg["maxqlen"], self.cfg["maxdoclen"]
+
         if query is not None:
             if qid is None:
                 query = self["tokenizer"].tokenize(query)
-                pass
+                idfs = self._idf2vec(query, qlen)
+                query = self._tok2vec(query, qlen)
             else:
                 raise RuntimeError("received both a qid and query, but only one can be passed")
 
         else:
-            query = self.qid2toks[qid]
+            # copy the cached arrays, so changing an instance in place (e.g., in a reranker) cannot corrupt the cache
+            query, idfs = self.qid2ids[qid].copy(), self.qid2idfs[qid].copy()
 
-        # TODO find a way to calculate qlen/doclen stats earlier, so we can log them and check sanity of our values
-        qlen, doclen = self.cfg["maxqlen"], self.cfg["maxdoclen"]
-        posdoc = self.docid2toks.get(posid, None)
-        if not posdoc:
+        posdoc = self.docid2ids.get(posid, None)
+        if posdoc is None:
             raise MissingDocError(qid, posid)
 
-        idfs = padlist(self._get_idf(query), qlen, 0)
-        query = self._tok2vec(padlist(query, qlen, self.pad_tok))
-        posdoc = self._tok2vec(padlist(posdoc, doclen, self.pad_tok))
+        posdoc = self._pad_ids(posdoc, doclen)
 
         # TODO determine whether pin_memory is happening. may not be because we don't place the strings in a np or torch object
         data = {
             "qid": qid,
             "posdocid": posid,
-            "idfs": np.array(idfs, dtype=np.float32),
-            "query": np.array(query, dtype=np.long),
-            "posdoc": np.array(posdoc, dtype=np.long),
-            "query_idf": np.array(idfs, dtype=np.float32),
+            "idfs": idfs,
+            "query": query,
+            "posdoc": posdoc,
+            "query_idf": idfs.copy(),
         }
 
         if not negid:
             logger.debug(f"missing negtive doc id for qid {qid}")
             return data
 
-        negdoc = self.docid2toks.get(negid, None)
-        if not negdoc:
+        negdoc = self.docid2ids.get(negid, None)
+        if negdoc is None:
             raise MissingDocError(qid, negid)
 
-        negdoc = self._tok2vec(padlist(negdoc, doclen, self.pad_tok))
         data["negdocid"] = negid
-        data["negdoc"] = np.array(negdoc, dtype=np.long)
+        data["negdoc"] = self._pad_ids(negdoc, doclen)
 
         return data
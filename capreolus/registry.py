@@ -169,6 +169,9 @@ class ModuleBase(RegisterableMixIn):
     commands = {}
     cfg = None
     config_keys_not_in_path = []
+    # config keys mapped to a default value; while the key has this value, it is not included in the module's path.
+    # this allows new options to be added without changing the paths of results produced before they existed.
+    config_defaults_not_in_path = {}
 
     @staticmethod
     def config():
@@ -204,6 +207,9 @@ class ModuleBase(RegisterableMixIn):
             for k, v in self.cfg.items()
             if k not in self.dependencies and (not self.config_keys_not_in_path or k not in self.config_keys_not_in_path)
         }
+        for k, default in self.config_defaults_not_in_path.items():
+            if k in module_cfg and module_cfg[k] == default:
+                del module_cfg[k]
         module_name_key = self.module_type + "-" + module_cfg.pop("_name")
         return "_".join([module_name_key] + [f"{k}-{v}" for k, v in sorted(module_cfg.items())])
 
@@ -1,9 +1,36 @@
 import os
 import pickle
+import zipfile
+
+import torch
 
 from capreolus.registry import ModuleBase, RegisterableModule, Dependency
 
 
+def _copy_to_cpu(obj):
+    """ Recursively copy the tensors in a (nested) state_dict to the CPU """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: _copy_to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_copy_to_cpu(v) for v in obj)
+    return obj
+
+
+def _load_state_dict(fn):
+    """ Load a state_dict written by torch.save or, as by older versions, pickled directly """
+    if not zipfile.is_zipfile(fn):
+        with open(fn, "rb") as f:
+            obj = pickle.load(f)
+
+        # torch.save's non-zip format begins with a pickled magic number, whereas older versions pickled the state_dict
+        if not (isinstance(obj, int) and obj == torch.serialization.MAGIC_NUMBER):
+            return obj
+
+    return torch.load(fn)
+
+
 class Reranker(ModuleBase, metaclass=RegisterableModule):
     """the module base class"""
 
@@ -13,24 +40,49 @@ class Reranker(ModuleBase, metaclass=RegisterableModule):
         "trainer": Dependency(module="trainer", name="pytorch"),
     }
 
+    def _get_save_keys(self):
+        """ Return the model's state_dict keys that should be saved (i.e., excluding embeddings and _nosave_ modules) """
+        # the keys are cached along with the model they were computed for, since the model may be rebuilt
+        if getattr(self, "_save_keys_model", None) is not self.model:
+            self._save_keys = tuple(k for k in self.model.state_dict() if "embedding.weight" not in k and "_nosave_" not in k)
+            self._save_keys_model = self.model
+        return self._save_keys
+
     def save_weights(self, weights_fn, optimizer):
+        state_dict = self.model.state_dict()
+        d = {k: state_dict[k] for k in self._get_save_keys()}
+        self.write_weights(weights_fn, d, optimizer.state_dict())
+
+    def snapshot_weights(self, optimizer):
+        """ Return CPU copies of the model and optimizer states written by `save_weights`.
+            Unlike the live state_dicts, these copies are not modified by further training, so they can be passed to
+            `write_weights` in a background thread while training continues. """
+        state_dict = self.model.state_dict()
+        d = {k: state_dict[k].detach().to("cpu", copy=True) for k in self._get_save_keys()}
+        return d, _copy_to_cpu(optimizer.state_dict())
+
+    def write_weights(self, weights_fn, model_state, optimizer_state):
         if not os.path.exists(os.path.dirname(weights_fn)):
-            os.makedirs(os.path.dirname(weights_fn))
+            os.makedirs(os.path.dirname(weights_fn), exist_ok=True)
 
-        d = {k: v for k, v in self.model.state_dict().items() if ("embedding.weight" not in k and "_nosave_" not in k)}
-        with open(weights_fn, "wb") as outf:
-            pickle.dump(d, outf, protocol=-1)
+        # write to temporary files that replace the old ones once complete, so a checkpoint is never partially written
+        # (e.g., if training is interrupted while weights are written in the background)
+        weights_tmp_fn = weights_fn.as_posix() + ".tmp"
+        # torch.save writes each tensor's storage directly rather than copying it into a pickle buffer
+        torch.save(model_state, weights_tmp_fn, pickle_protocol=pickle.HIGHEST_PROTOCOL)
 
         optimizer_fn = weights_fn.as_posix() + ".optimizer"
-        with open(optimizer_fn, "wb") as outf:
-            pickle.dump(optimizer.state_dict(), outf, protocol=-1)
+        optimizer_tmp_fn = optimizer_fn + ".tmp"
+        with open(optimizer_tmp_fn, "wb") as outf:
+            pickle.dump(optimizer_state, outf, protocol=-1)
+
+        os.replace(weights_tmp_fn, weights_fn)
+        os.replace(optimizer_tmp_fn, optimizer_fn)
 
     def load_weights(self, weights_fn, optimizer):
-        with open(weights_fn, "rb") as f:
-            d = pickle.load(f)
+        d = _load_state_dict(weights_fn)
 
-        cur_keys = set(k for k in self.model.state_dict().keys() if not ("embedding.weight" in k or "_nosave_" in k))
-        missing = cur_keys - set(d.keys())
+        missing = set(self._get_save_keys()) - set(d.keys())
         if len(missing) > 0:
             raise RuntimeError("loading state_dict with keys that do not match current model: %s" % missing)
 
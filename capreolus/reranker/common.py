@@ -1,17 +1,20 @@
-import torch
-
+from typing import List
 
-_hinge_loss = torch.nn.MarginRankingLoss(margin=1, reduction="mean")
+import torch
 
 
-def pair_softmax_loss(pos_neg_scores):
+# the pairwise losses are scripted so that their elementwise ops can be fused into fewer kernels.
+# set the environment variable PYTORCH_JIT=0 to run them (and any other scripted code) as plain python for debugging.
+@torch.jit.script
+def pair_softmax_loss(pos_neg_scores: List[torch.Tensor]) -> torch.Tensor:
     scores = torch.stack(pos_neg_scores, dim=1)
     return torch.mean(1.0 - scores.softmax(dim=1)[:, 0])
 
 
-def pair_hinge_loss(pos_neg_scores):
-    label = torch.ones_like(pos_neg_scores[0])  # , dtype=torch.int)
-    return _hinge_loss(pos_neg_scores[0], pos_neg_scores[1], label)
+@torch.jit.script
+def pair_hinge_loss(pos_neg_scores: List[torch.Tensor]) -> torch.Tensor:
+    # equivalent to MarginRankingLoss(margin=1, reduction="mean") with a target of 1 (pos should be ranked higher)
+    return torch.clamp(1.0 - pos_neg_scores[0] + pos_neg_scores[1], min=0.0).mean()
 
 
 class SimilarityMatrix(torch.nn.Module):
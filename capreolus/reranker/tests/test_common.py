@@ -0,0 +1,22 @@
+import torch
+
+from capreolus.reranker.common import pair_hinge_loss
+
+
+def test_pair_hinge_loss_matches_margin_ranking_loss():
+    torch.manual_seed(123)
+    # include pairs on both sides of the margin (and with equal scores)
+    pos = torch.cat([torch.randn(32), torch.tensor([0.0, 1.0, 2.0])])
+    neg = torch.cat([torch.randn(32), torch.tensor([0.0, 0.0, 0.0])])
+
+    pos_a, neg_a = pos.clone().requires_grad_(), neg.clone().requires_grad_()
+    loss = pair_hinge_loss([pos_a, neg_a])
+    loss.backward()
+
+    pos_b, neg_b = pos.clone().requires_grad_(), neg.clone().requires_grad_()
+    expected = torch.nn.MarginRankingLoss(margin=1, reduction="mean")(pos_b, neg_b, torch.ones_like(pos_b))
+    expected.backward()
+
+    assert torch.allclose(loss, expected)
+    assert torch.allclose(pos_a.grad, pos_b.grad)
+    assert torch.allclose(neg_a.grad, neg_b.grad)
@@ -0,0 +1,77 @@
+import pickle
+from pathlib import Path
+
+import pytest
+import torch
+
+from capreolus.reranker import Reranker
+
+
+class LinearReranker(Reranker):
+    name = "test_linear"
+
+    def build(self):
+        self.model = torch.nn.Linear(2, 1)
+
+
+def build_reranker_and_optimizer():
+    reranker = LinearReranker({"_name": "test_linear"})
+    reranker.build()
+    optimizer = torch.optim.Adam(reranker.model.parameters(), lr=0.1)
+
+    # take a step so that the optimizer has state
+    reranker.model(torch.ones(1, 2)).sum().backward()
+    optimizer.step()
+    return reranker, optimizer
+
+
+def assert_loaded(weights_fn, saved):
+    reranker, optimizer = build_reranker_and_optimizer()
+    reranker.load_weights(weights_fn, optimizer)
+
+    loaded = reranker.model.state_dict()
+    assert all(torch.equal(saved[k], loaded[k]) for k in saved)
+
+
+def test_load_weights(tmpdir):
+    reranker, optimizer = build_reranker_and_optimizer()
+    saved = {k: v.clone() for k, v in reranker.model.state_dict().items()}
+
+    weights_fn = Path(tmpdir) / "weights.p"
+    reranker.save_weights(weights_fn, optimizer)
+    assert_loaded(weights_fn, saved)
+
+
+def test_load_legacy_pickled_weights(tmpdir):
+    reranker, optimizer = build_reranker_and_optimizer()
+    saved = {k: v.clone() for k, v in reranker.model.state_dict().items()}
+
+    # older versions pickled the state_dicts directly
+    weights_fn = Path(tmpdir) / "weights.p"
+    with open(weights_fn, "wb") as outf:
+        pickle.dump(reranker.model.state_dict(), outf, protocol=-1)
+    with open(weights_fn.as_posix() + ".optimizer", "wb") as outf:
+        pickle.dump(optimizer.state_dict(), outf, protocol=-1)
+
+    assert_loaded(weights_fn, saved)
+
+
+def test_load_weights_with_missing_keys(tmpdir):
+    reranker, optimizer = build_reranker_and_optimizer()
+
+    weights_fn = Path(tmpdir) / "weights.p"
+    torch.save({"weight": reranker.model.weight}, weights_fn)
+    with pytest.raises(RuntimeError, match="bias"):
+        reranker.load_weights(weights_fn, optimizer)
+
+
+def test_save_weights_after_replacing_model(tmpdir):
+    reranker, optimizer = build_reranker_and_optimizer()
+    reranker.save_weights(Path(tmpdir) / "before.p", optimizer)
+
+    # the saved keys follow the current model
+    reranker.model = torch.nn.Sequential(torch.nn.Linear(2, 2), torch.nn.Linear(2, 1))
+    optimizer = torch.optim.Adam(reranker.model.parameters(), lr=0.1)
+    weights_fn = Path(tmpdir) / "after.p"
+    reranker.save_weights(weights_fn, optimizer)
+    assert set(torch.load(weights_fn).keys()) == set(reranker.model.state_dict().keys())
@@ -12,6 +12,8 @@ logger = get_logger(__name__)
 class TrainDataset(torch.utils.data.IterableDataset):
     """
     Samples training data. Intended to be used with a pytorch DataLoader
+
+    Each DataLoader worker reseeds python's random module, so workers sample independent streams of triplets.
     """
 
     def __init__(self, qid_docid_to_rank, qrels, extractor):
@@ -19,37 +21,38 @@ class TrainDataset(torch.utils.data.IterableDataset):
         self.iterations = 0
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
-        # remove qids from qid_docid_to_rank that do not have relevance labels in the qrels
-        qid_docid_to_rank = qid_docid_to_rank.copy()
-        for qid in list(qid_docid_to_rank.keys()):
+        # split each qid's docids into relevant and non-relevant documents in a single pass, skipping qids that
+        # either do not have relevance labels in the qrels or do not have both kinds of documents for training
+        self.qid_to_reldocs = {}
+        self.qid_to_negdocs = {}
+        n_labeled_qid = 0
+        for qid, docids in qid_docid_to_rank.items():
             if qid not in qrels:
                 logger.warning("skipping qid=%s that was missing from the qrels", qid)
-                del qid_docid_to_rank[qid]
-
-        self.qid_to_reldocs = {
-            qid: [docid for docid in docids if (qrels[qid].get(docid, 0) > 0 and extractor.has_doc(docid))]
-            for qid, docids in qid_docid_to_rank.items()
-        }
-
-        self.qid_to_negdocs = {
-            qid: [docid for docid in docids if (qrels[qid].get(docid, 0) <= 0 and extractor.has_doc(docid))]
-            for qid, docids in qid_docid_to_rank.items()
-        }
-
-        # remove any qids that do not have both relevant and non-relevant documents for training
-        n_valid_qid = len(qid_docid_to_rank)
-        for qid in qid_docid_to_rank:
-            posdocs = len(self.qid_to_reldocs[qid])
-            negdocs = len(self.qid_to_negdocs[qid])
-
-            if posdocs == 0 or negdocs == 0:
-                logger.warning("removing training qid=%s with %s positive docs and %s negative docs", qid, posdocs, negdocs)
-                del self.qid_to_reldocs[qid]
-                del self.qid_to_negdocs[qid]
-                n_valid_qid -= 1
-
-        left_percentage = n_valid_qid/len(qid_docid_to_rank)
-        log = f"{n_valid_qid} out of {len(qid_docid_to_rank)} () queries are kept"
+                continue
+
+            n_labeled_qid += 1
+            qrel = qrels[qid]
+            reldocs, negdocs = [], []
+            for docid in docids:
+                if extractor.has_doc(docid):
+                    if qrel.get(docid, 0) > 0:
+                        reldocs.append(docid)
+                    else:
+                        negdocs.append(docid)
+
+            if len(reldocs) == 0 or len(negdocs) == 0:
+                logger.warning(
+                    "removing training qid=%s with %s positive docs and %s negative docs", qid, len(reldocs), len(negdocs)
+                )
+                continue
+
+            self.qid_to_reldocs[qid] = reldocs
+            self.qid_to_negdocs[qid] = negdocs
+
+        n_valid_qid = len(self.qid_to_reldocs)
+        left_percentage = n_valid_qid / n_labeled_qid
+        log = f"{n_valid_qid} out of {n_labeled_qid} () queries are kept"
         if left_percentage < 0.5:
             logger.warning(log)
         else:
@@ -57,16 +60,20 @@ class TrainDataset(torch.utils.data.IterableDataset):
 
     def generator_func(self):
         # Convert each query and doc id to the corresponding feature/embedding and yield
-        while True:
-            all_qids = sorted(self.qid_to_reldocs)
-            if len(all_qids) == 0:
-                raise RuntimeError("TrainDataset has no valid qids")
+        sorted_qids = sorted(self.qid_to_reldocs)
+        if len(sorted_qids) == 0:
+            raise RuntimeError("TrainDataset has no valid qids")
 
+        # each qid is visited once per pass, so there is only a single pos/neg draw per qid to make.
+        # we keep using the global random module, which is seeded by the task and reseeded in each DataLoader worker
+        qid_to_reldocs, qid_to_negdocs = self.qid_to_reldocs, self.qid_to_negdocs
+        while True:
+            all_qids = sorted_qids.copy()
             random.shuffle(all_qids)
 
             for qid in all_qids:
-                posdocid = random.choice(self.qid_to_reldocs[qid])
-                negdocid = random.choice(self.qid_to_negdocs[qid])
+                posdocid = random.choice(qid_to_reldocs[qid])
+                negdocid = random.choice(qid_to_negdocs[qid])
 
                 try:
                     yield self.extractor.id2vec(qid, posdocid, negdocid)
@@ -87,6 +94,8 @@ class TrainDataset(torch.utils.data.IterableDataset):
 class PredDataset(torch.utils.data.IterableDataset):
     """
     Creates a Dataset for evaluation (test) data to be used with a pytorch DataLoader
+
+    When used with multiple DataLoader workers, each worker yields a disjoint subset of the (qid, docid) pairs.
     """
 
     def __init__(self, qid_docid_to_rank, extractor, qrels=None, mode="val"):
@@ -95,7 +104,8 @@ class PredDataset(torch.utils.data.IterableDataset):
         if mode == "val" and not qrels:
             raise ValueError("qrels must be provide for validation data generator")
 
-        def genf():
+        def genf(worker_id=0, num_workers=1):
+            instance_idx = -1
             for qid, docids in qid_docid_to_rank.items():
                 if mode == "val":
                     if qid not in qrels:
@@ -111,6 +121,11 @@ class PredDataset(torch.utils.data.IterableDataset):
                         continue
 
                 for docid in docids:
+                    # each DataLoader worker is responsible for a disjoint subset of the instances
+                    instance_idx += 1
+                    if instance_idx % num_workers != worker_id:
+                        continue
+
                     try:
                         yield extractor.id2vec(qid, docid)
                     except MissingDocError:
@@ -127,4 +142,8 @@ class PredDataset(torch.utils.data.IterableDataset):
         Returns: Tuples of the form (query_feature, posdoc_feature)
         """
 
-        return iter(self.generator_func())
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            return iter(self.generator_func())
+
+        return iter(self.generator_func(worker_info.id, worker_info.num_workers))
@@ -55,3 +55,19 @@ def test_pred_sampler(monkeypatch, tmpdir):
         assert np.array_equal(batch["query"][1], np.array([1, 2, 3, 4]))
         assert np.array_equal(batch["posdoc"][0], np.array([1, 1, 1, 1]))
         assert np.array_equal(batch["posdoc"][1], np.array([1, 1, 1, 1]))
+
+
+def test_pred_sampler_with_workers(monkeypatch, tmpdir):
+    search_run = {"301": {"LA010189-0001": 50, "LA010189-0002": 100, "LA010189-0003": 25}, "302": {"LA010189-0004": 10}}
+    extractor = EmbedText({"keepstops": True})
+    pred_dataset = PredDataset(search_run, extractor, mode="test")
+
+    def mock_id2vec(self, qid, posid, *args, **kwargs):
+        return {"qid": qid, "posdocid": posid, "query": np.array([1, 2, 3, 4]), "posdoc": np.array([1, 1, 1, 1])}
+
+    monkeypatch.setattr(EmbedText, "id2vec", mock_id2vec)
+    dataloader = torch.utils.data.DataLoader(pred_dataset, batch_size=1, num_workers=2)
+    seen = [(batch["qid"][0], batch["posdocid"][0]) for batch in dataloader]
+
+    # each (qid, docid) pair should be produced by exactly one worker
+    assert sorted(seen) == sorted((qid, docid) for qid, docids in search_run.items() for docid in docids)
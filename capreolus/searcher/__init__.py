@@ -43,6 +43,25 @@ class Searcher(ModuleBase, metaclass=RegisterableModule):
                     rank += 1
                     count += 1
 
+    @staticmethod
+    def write_trec_run_columnar(qids, docids, scores, outfn):
+        """ Write a run given as parallel sequences of qids, docids, and scores (rather than as a dict of dicts).
+            The output matches `write_trec_run`, including the order of documents with tied scores. """
+        qids, docids, scores = np.asarray(qids), np.asarray(docids), np.asarray(scores)
+
+        # sort by qid and then by descending score; lexsort is stable, so ties keep their original order
+        order = np.lexsort((-scores, qids))
+        qids, docids, scores = qids[order], docids[order], scores[order]
+
+        # ranks restart at 1 at the first position of each qid
+        qid_starts = np.concatenate(([0], np.flatnonzero(qids[1:] != qids[:-1]) + 1))
+        qid_lens = np.diff(np.concatenate((qid_starts, [len(qids)])))
+        ranks = np.arange(len(qids)) - np.repeat(qid_starts, qid_lens) + 1
+
+        with open(outfn, "wt") as outf:
+            for qid, docid, rank, score in zip(qids.tolist(), docids.tolist(), ranks.tolist(), scores.tolist()):
+                print(f"{qid} Q0 {docid} {rank} {score} capreolus", file=outf)
+
 
 class AnseriniSearcherMixIn:
     """ MixIn for searchers that use Anserini's SearchCollection script """
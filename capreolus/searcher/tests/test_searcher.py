@@ -4,7 +4,7 @@ import pytest
 from sacred.config import ConfigScope
 
 from capreolus.benchmark import DummyBenchmark
-from capreolus.searcher import BM25, BM25Grid
+from capreolus.searcher import Searcher, BM25, BM25Grid
 from capreolus.tests.common_fixtures import tmpdir_as_cache, dummy_index
 
 
@@ -41,3 +41,20 @@ def test_searcher_bm25_grid(tmpdir_as_cache, tmpdir, dummy_index):
         for b in bs:
             assert os.path.exists(os.path.join(output_fn, "searcher_k1={0},b={1}".format(k1, b)))
     assert os.path.exists(os.path.join(output_fn, "done"))
+
+
+def test_write_trec_run_columnar(tmpdir):
+    qids = ["302", "301", "302", "301", "301"]
+    docids = ["d1", "d2", "d3", "d4", "d5"]
+    scores = np.array([0.5, 1.5, 2.5, 1.5, -1.0], dtype=np.float16)
+
+    preds = {}
+    for qid, docid, score in zip(qids, docids, scores.tolist()):
+        preds.setdefault(qid, {})[docid] = score
+
+    dict_fn, columnar_fn = os.path.join(tmpdir, "dict.run"), os.path.join(tmpdir, "columnar.run")
+    Searcher.write_trec_run(preds, dict_fn)
+    Searcher.write_trec_run_columnar(qids, docids, scores, columnar_fn)
+
+    with open(dict_fn) as f1, open(columnar_fn) as f2:
+        assert f1.read() == f2.read()
@@ -123,6 +123,16 @@ def test_embedtext_id2vec():
 
     assert error_thrown
 
+    # changing an instance in place does not change later instances for the same query
+    assert data["query_idf"] is not data["idfs"]
+    expected_q, expected_idf = q.copy(), idf.copy()
+    q += 1
+    idf += 1
+    data = extractor.id2vec(qid, docid1, docid2)
+    assert (data["query"] == expected_q).all()
+    assert (data["idfs"] == expected_idf).all()
+    assert (data["query_idf"] == expected_idf).all()
+
 
 def fake_sampler():
     pass
@@ -1,5 +1,10 @@
+import inspect
 import os
 import json
+import pickle
+import random
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
@@ -13,6 +18,9 @@ from capreolus import evaluator
 
 logger = get_logger(__name__)  # pylint: disable=invalid-name
 
+# newer versions of torch provide a multi-tensor Adam implementation that updates all parameters with a few fused kernels
+ADAM_SUPPORTS_FOREACH = "foreach" in inspect.signature(torch.optim.Adam).parameters
+
 
 class Trainer(ModuleBase, metaclass=RegisterableModule):
     module_type = "trainer"
@@ -21,7 +29,16 @@ class Trainer(ModuleBase, metaclass=RegisterableModule):
 class PytorchTrainer(Trainer):
     name = "pytorch"
     dependencies = {}
-    config_keys_not_in_path = ["niters"]
+    config_keys_not_in_path = ["niters", "numworkers", "cudnnbenchmark"]
+    # amp and tf32 change the model's numerics, so they are part of the path only when enabled
+    config_defaults_not_in_path = {"amp": False, "tf32": False}
+
+    def __init__(self, cfg):
+        super().__init__(cfg)
+        self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        self.optimizer = None
+        # the model whose parameters self.optimizer updates
+        self._optimizer_model = None
 
     @staticmethod
     def config():
@@ -36,8 +53,12 @@ class PytorchTrainer(Trainer):
         lr = 0.001  # learning rate
         dropoutrate = 0  # dropout rate
         softmaxloss = False  # True to use softmax loss (over pairs) or False to use hinge loss
+        amp = False  # True to train with automatic mixed precision (requires a GPU and torch >= 1.6)
+        tf32 = False  # True to allow TF32 matmuls and convolutions on supporting GPUs (faster, less precise; torch >= 1.7)
 
         interactive = False  # True for training with Notebook or False for command line environment
+        numworkers = 0  # number of DataLoader worker processes preparing batches (0 prepares them in the main process)
+        cudnnbenchmark = True  # True to let cuDNN pick the fastest kernels for our fixed input shapes (False for determinism)
 
         # sanity checks
         if batch < 1:
@@ -55,6 +76,9 @@ class PytorchTrainer(Trainer):
         if lr <= 0:
             raise ValueError("lr must be > 0")
 
+        if numworkers < 0 or not float(numworkers).is_integer():
+            raise ValueError("numworkers must be an integer >= 0")
+
     def single_train_iteration(self, reranker, train_dataloader):
         """Train model for one iteration using instances from train_dataloader.
 
@@ -67,56 +91,103 @@ class PytorchTrainer(Trainer):
 
         """
 
-        iter_loss = []
+        # keep a running sum of detached losses rather than a list, so no batch's loss tensor is retained
+        iter_loss_sum = torch.zeros((), device=self.device)
+        nbatches = 0
         batches_since_update = 0
         batches_per_epoch = self.cfg["itersize"] // self.cfg["batch"]
         batches_per_step = self.cfg["gradacc"]
 
+        tensor_keys = None
         for bi, batch in enumerate(train_dataloader):
             # TODO make sure _prepare_batch_with_strings equivalent is happening inside the sampler
-            batch = {k: v.to(self.device) if not isinstance(v, list) else v for k, v in batch.items()}
-            doc_scores = reranker.score(batch)
-            loss = self.loss(doc_scores)
-            iter_loss.append(loss)
-            loss.backward()
+            # every batch has the same schema, so find the tensor fields (i.e., not lists of ids) once
+            if tensor_keys is None:
+                tensor_keys = {k for k, v in batch.items() if torch.is_tensor(v)}
+            # the DataLoader pins batches, so the copies to the device can be asynchronous
+            batch = {k: (v.to(self.device, non_blocking=True) if k in tensor_keys else v) for k, v in batch.items()}
+            if self.scaler:
+                with torch.cuda.amp.autocast():
+                    doc_scores = reranker.score(batch)
+                    loss = self.loss(doc_scores)
+                self.scaler.scale(loss).backward()
+            else:
+                doc_scores = reranker.score(batch)
+                loss = self.loss(doc_scores)
+                loss.backward()
+
+            iter_loss_sum += loss.detach()
+            nbatches += 1
 
             batches_since_update += 1
             if batches_since_update == batches_per_step:
                 batches_since_update = 0
-                self.optimizer.step()
+                if self.scaler:
+                    self.scaler.step(self.optimizer)
+                    self.scaler.update()
+                else:
+                    self.optimizer.step()
                 self.optimizer.zero_grad()
 
             if (bi + 1) % batches_per_epoch == 0:
                 break
 
-        return torch.stack(iter_loss).mean()
+        return iter_loss_sum / max(nbatches, 1)
 
     def load_loss_file(self, fn):
         """Loads loss history from fn
 
         Args:
-           fn (Path): path to a loss.txt file
+           fn (Path): path to a loss.npy file. If it does not exist, the loss.txt file written by older versions
+                      in the same directory is read instead. (loss.npy always takes precedence, and writing it with
+                      `write_loss_file` removes the loss.txt file.)
 
         Returns:
             a list of losses ordered by iterations
 
         """
 
-        loss = []
-        with fn.open(mode="rt") as f:
-            for lineidx, line in enumerate(f):
-                line = line.strip()
-                if not line:
-                    continue
-
-                iteridx, iterloss = line.rstrip().split()
+        legacy_fn = fn.with_suffix(".txt")
+        if not fn.exists() and legacy_fn.exists():
+            return self._load_loss_txt(legacy_fn)
 
-                if int(iteridx) != lineidx:
-                    raise IOError(f"malformed loss file {fn} ... did two processes write to it?")
-
-                loss.append(float(iterloss))
+        try:
+            return np.load(fn).tolist()
+        except ValueError as e:
+            raise IOError(f"malformed loss file {fn}") from e
+
+    def _load_loss_txt(self, fn):
+        """ Loads loss history from a loss.txt file containing one `iteration loss` line per iteration """
+        with warnings.catch_warnings():
+            # an empty loss file is valid and simply contains no iterations
+            warnings.filterwarnings("ignore", message="loadtxt", category=UserWarning)
+            try:
+                loss = np.loadtxt(fn, dtype=[("iteridx", np.int64), ("loss", np.float64)], ndmin=1)
+            except ValueError as e:
+                raise IOError(f"malformed loss file {fn}") from e
+
+        if not np.array_equal(loss["iteridx"], np.arange(len(loss))):
+            raise IOError(f"malformed loss file {fn} ... did two processes write to it?")
+
+        return loss["loss"].tolist()
+
+    def write_loss_file(self, fn, loss):
+        """Atomically (over)write the loss history in fn with loss, a list of losses ordered by iterations.
+
+        The whole history is rewritten rather than appended to, because fastforward_training relies on the loss file
+        to find the last complete iteration: an interrupted append could leave a partial entry, whereas os.replace
+        never does. The history holds one float per iteration, so rewriting it is negligible next to the checkpoint
+        written each iteration.
+        """
+        tmp_fn = fn.with_name(fn.name + ".tmp")
+        with tmp_fn.open(mode="wb") as f:
+            np.save(f, np.asarray(loss, dtype=np.float64))
+        os.replace(tmp_fn, fn)
 
-        return loss
+        # the loss.txt file written by older versions has been migrated, and loss.npy would take precedence over it anyway
+        legacy_fn = fn.with_suffix(".txt")
+        if legacy_fn.exists():
+            os.remove(legacy_fn)
 
     def fastforward_training(self, reranker, weights_path, loss_fn):
         """Skip to the last training iteration whose weights were saved.
@@ -129,10 +200,13 @@ class PytorchTrainer(Trainer):
         If an error or inconsistency is encountered when checking for weights, this method returns 0.
 
         This method checks several files to determine if weights "are available". First, loss_fn is read to
-        determine the last recorded iteration. (If a path is missing or loss_fn is malformed, 0 is returned.)
+        determine the last recorded iteration. (If a path is missing or loss_fn is malformed, 0 is returned.
+        See `load_loss_file` for how loss files written by older versions are handled.)
         Second, the weights from the last recorded iteration in loss_fn are loaded into the model and optimizer.
         If this is successful, the method returns `1 + last recorded iteration`. If not, it returns 0.
         (We consider loss_fn because it is written at the end of every training iteration.)
+        The RNG states saved with those weights are also restored, so training continues to sample the same
+        instances that it would have sampled without being interrupted.
 
         Args:
            model (Reranker): a PyTorch Reranker whose state should be loaded
@@ -145,7 +219,7 @@ class PytorchTrainer(Trainer):
 
         """
 
-        if not (weights_path.exists() and loss_fn.exists()):
+        if not weights_path.exists():
             return 0
 
         try:
@@ -158,11 +232,37 @@ class PytorchTrainer(Trainer):
 
         try:
             reranker.load_weights(weights_fn, self.optimizer)
-            return last_loss_iteration + 1
         except:
             logger.info("attempted to load weights from %s but failed, starting at iteration 0", weights_fn)
             return 0
 
+        try:
+            self._load_rng_state(weights_fn.as_posix() + ".rng")
+        except FileNotFoundError:
+            logger.warning("no RNG state saved with %s; training will not sample the same instances as before", weights_fn)
+
+        return last_loss_iteration + 1
+
+    def _save_rng_state(self, fn):
+        """ Save the RNG states that determine which training instances are sampled (and dropout masks) to fn """
+        state = {"random": random.getstate(), "numpy": np.random.get_state(), "torch": torch.random.get_rng_state()}
+        if torch.cuda.is_available():
+            state["cuda"] = torch.cuda.get_rng_state_all()
+
+        with open(fn, "wb") as outf:
+            pickle.dump(state, outf, protocol=-1)
+
+    def _load_rng_state(self, fn):
+        """ Restore the RNG states saved by `_save_rng_state` """
+        with open(fn, "rb") as f:
+            state = pickle.load(f)
+
+        random.setstate(state["random"])
+        np.random.set_state(state["numpy"])
+        torch.random.set_rng_state(state["torch"])
+        if "cuda" in state and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state["cuda"])
+
     def train(self, reranker, train_dataset, train_output_path, dev_data, dev_output_path, qrels, metric):
         """Train a model following the trainer's config (specifying batch size, number of iterations, etc).
 
@@ -174,9 +274,21 @@ class PytorchTrainer(Trainer):
 
         """
 
-        self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        # batch shapes are fixed by batch, maxqlen, and maxdoclen, so cuDNN's autotuning only needs to happen once
+        torch.backends.cudnn.benchmark = self.cfg["cudnnbenchmark"]
+        if hasattr(torch.backends, "cuda") and hasattr(torch.backends.cuda, "matmul"):
+            torch.backends.cuda.matmul.allow_tf32 = self.cfg["tf32"]
+            torch.backends.cudnn.allow_tf32 = self.cfg["tf32"]
+
         model = reranker.model.to(self.device)
-        self.optimizer = torch.optim.Adam(filter(lambda param: param.requires_grad, model.parameters()), lr=self.cfg["lr"])
+        self.optimizer = self._create_optimizer(model)
+        self._optimizer_model = model
+
+        self.scaler = None
+        if self.cfg["amp"]:
+            if not (torch.cuda.is_available() and hasattr(torch.cuda, "amp")):
+                raise RuntimeError("amp requires a GPU and torch >= 1.6")
+            self.scaler = torch.cuda.amp.GradScaler()
 
         if self.cfg["softmaxloss"]:
             self.loss = pair_softmax_loss
@@ -190,102 +302,160 @@ class PytorchTrainer(Trainer):
         os.makedirs(weights_output_path, exist_ok=True)
         os.makedirs(info_output_path, exist_ok=True)
 
-        loss_fn = info_output_path / "loss.txt"
+        loss_fn = info_output_path / "loss.npy"
         metrics_fn = dev_output_path / "metrics.json"
         metrics_history = {}
         initial_iter = self.fastforward_training(reranker, weights_output_path, loss_fn)
         logger.info("starting training from iteration %s/%s", initial_iter, self.cfg["niters"])
 
         train_dataloader = torch.utils.data.DataLoader(
-            train_dataset, batch_size=self.cfg["batch"], pin_memory=True, num_workers=0
+            train_dataset, batch_size=self.cfg["batch"], pin_memory=True, num_workers=self.cfg["numworkers"]
         )
+        dev_dataloader = self._create_pred_dataloader(dev_data)
 
         train_loss = []
-        # are we resuming training?
+        # are we resuming training? (the sampler does not need to be fastforwarded, since its RNG state was restored)
         if initial_iter > 0:
             train_loss = self.load_loss_file(loss_fn)
+            # dev.best is written by the background evaluation, which may not have finished for the last recorded
+            # iteration (e.g., if the process was killed). rewrite it from that iteration's weights, which are loaded.
+            reranker.write_weights(dev_best_weight_fn, *reranker.snapshot_weights(self.optimizer))
 
-            # are we done training?
-            if initial_iter < self.cfg["niters"]:
-                logger.debug("fastforwarding train_dataloader to iteration %s", initial_iter)
-                batches_per_epoch = self.cfg["itersize"] // self.cfg["batch"]
-                for niter in range(initial_iter):
-                    for bi, batch in enumerate(train_dataloader):
-                        if (bi + 1) % batches_per_epoch == 0:
-                            break
+        # drop any stale entries (and convert loss files written by older versions)
+        self.write_loss_file(loss_fn, train_loss)
 
         dev_best_metric = -np.inf
-        for niter in range(initial_iter, self.cfg["niters"]):
-            model.train()
-
-            iter_loss_tensor = self.single_train_iteration(reranker, train_dataloader)
-
-            train_loss.append(iter_loss_tensor.item())
-            logger.info("iter = %d loss = %f", niter, train_loss[-1])
-
-            # write model weights to file
-            weights_fn = weights_output_path / f"{niter}.p"
-            reranker.save_weights(weights_fn, self.optimizer)
-
-            # predict performance on dev set
-            pred_fn = dev_output_path / f"{niter}.run"
-            preds = self.predict(reranker, dev_data, pred_fn)
 
+        def evaluate_dev_preds(preds, weights_state):
             # log dev metrics
             metrics = evaluator.eval_runs(preds, qrels, ["ndcg_cut_20", "map", "P_20"])
             logger.info("dev metrics: %s", " ".join([f"{metric}={v:0.3f}" for metric, v in sorted(metrics.items())]))
 
             # write best dev weights to file
             if metrics[metric] > dev_best_metric:
-                reranker.save_weights(dev_best_weight_fn, self.optimizer)
+                reranker.write_weights(dev_best_weight_fn, *weights_state)
             for m in metrics:
                 metrics_history.setdefault(m, []).append(metrics[m])
 
-            # write train_loss to file
-            loss_fn.write_text("\n".join(f"{idx} {loss}" for idx, loss in enumerate(train_loss)))
+        # weights are written to disk by a background thread while predicting on the dev set, and dev predictions are
+        # evaluated by another background thread while the next iteration trains
+        save_pool = ThreadPoolExecutor(max_workers=1)
+        eval_pool = ThreadPoolExecutor(max_workers=1)
+        pending_save, pending_eval = None, None
+        try:
+            for niter in range(initial_iter, self.cfg["niters"]):
+                model.train()
+
+                iter_loss_tensor = self.single_train_iteration(reranker, train_dataloader)
+
+                train_loss.append(iter_loss_tensor.item())
+                logger.info("iter = %d loss = %f", niter, train_loss[-1])
+
+                # write model weights to file
+                weights_fn = weights_output_path / f"{niter}.p"
+                weights_state = reranker.snapshot_weights(self.optimizer)
+                pending_save = save_pool.submit(reranker.write_weights, weights_fn, *weights_state)
+
+                # predict performance on dev set
+                pred_fn = dev_output_path / f"{niter}.run"
+                preds = self.predict(reranker, dev_data, pred_fn, pred_dataloader=dev_dataloader)
+
+                # save the RNG state only now, since predicting draws from it (e.g., to seed the DataLoader's workers).
+                # this is the state the next iteration starts from, so a resumed run samples the same instances.
+                self._save_rng_state(weights_fn.as_posix() + ".rng")
+
+                # wait for the previous iteration's evaluation to finish (raising any errors) before submitting this one
+                if pending_eval:
+                    pending_eval.result()
+                pending_eval = eval_pool.submit(evaluate_dev_preds, preds, weights_state)
+
+                # the loss file indicates which weights are available (see fastforward_training), so finish writing them first
+                pending_save.result()
+
+                # write train_loss to file
+                self.write_loss_file(loss_fn, train_loss)
+
+            if pending_eval:
+                pending_eval.result()
+        except BaseException as e:
+            # let the pending weights write and evaluation finish, but do not let their errors hide this one
+            for pending in (pending_save, pending_eval):
+                if pending and pending.exception() not in (None, e):
+                    logger.error("background task failed during training: %r", pending.exception())
+            raise
+        finally:
+            eval_pool.shutdown(wait=True)
+            save_pool.shutdown(wait=True)
 
         json.dump(metrics_history, open(metrics_fn, "w", encoding="utf-8"))
         plot_metrics(metrics_history, str(dev_output_path) + ".pdf", interactive=self.cfg["interactive"])
-        plot_loss(train_loss, str(loss_fn).replace(".txt", ".pdf"), interactive=self.cfg["interactive"])
+        plot_loss(train_loss, str(loss_fn.with_suffix(".pdf")), interactive=self.cfg["interactive"])
+
+    def _create_optimizer(self, model):
+        params = [param for param in model.parameters() if param.requires_grad]
+        if ADAM_SUPPORTS_FOREACH:
+            return torch.optim.Adam(params, lr=self.cfg["lr"], foreach=True)
+        return torch.optim.Adam(params, lr=self.cfg["lr"])
 
     def load_best_model(self, reranker, train_output_path):
-        self.optimizer = torch.optim.Adam(
-            filter(lambda param: param.requires_grad, reranker.model.parameters()), lr=self.cfg["lr"]
-        )
+        # an optimizer created for this model (e.g., by train) can be reused, since load_weights overwrites its state.
+        # if the reranker's model has been rebuilt since, the optimizer must be created for the new model's parameters.
+        if self.optimizer is None or self._optimizer_model is not reranker.model:
+            self.optimizer = self._create_optimizer(reranker.model)
+            self._optimizer_model = reranker.model
 
         dev_best_weight_fn = train_output_path / "dev.best"
         reranker.load_weights(dev_best_weight_fn, self.optimizer)
 
-    def predict(self, reranker, pred_data, pred_fn):
+    def _create_pred_dataloader(self, pred_data):
+        return torch.utils.data.DataLoader(
+            pred_data, batch_size=self.cfg["batch"], pin_memory=True, num_workers=self.cfg["numworkers"]
+        )
+
+    def predict(self, reranker, pred_data, pred_fn, pred_dataloader=None):
         """Predict query-document scores on `pred_data` using `model` and write a corresponding run file to `pred_fn`
 
         Args:
            model (Reranker): a PyTorch Reranker
            pred_data (IterableDataset): data to predict on
            pred_fn (Path): path to write the prediction run file to
+           pred_dataloader (DataLoader): an existing DataLoader over `pred_data` to reuse (e.g., across iterations).
+                                         If None, a new DataLoader is created.
 
         Returns:
            TREC Run 
 
         """
 
-        self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-        # save to pred_fn
-        model = reranker.model.to(self.device)
+        # the model is already on the device when called from train()
+        model = reranker.model
+        if next(model.parameters()).device != self.device:
+            model = model.to(self.device)
         model.eval()
 
-        preds = {}
-        pred_dataloader = torch.utils.data.DataLoader(pred_data, batch_size=self.cfg["batch"], pin_memory=True, num_workers=0)
+        if pred_dataloader is None:
+            pred_dataloader = self._create_pred_dataloader(pred_data)
+
+        qids, docids, score_chunks = [], [], []
+        tensor_keys = None
         with torch.autograd.no_grad():
             for bi, batch in enumerate(pred_dataloader):
-                batch = {k: v.to(self.device) if not isinstance(v, list) else v for k, v in batch.items()}
+                if tensor_keys is None:
+                    tensor_keys = {k for k, v in batch.items() if torch.is_tensor(v)}
+                batch = {k: (v.to(self.device, non_blocking=True) if k in tensor_keys else v) for k, v in batch.items()}
                 scores = reranker.test(batch)
-                scores = scores.view(-1).cpu().numpy()
-                for qid, docid, score in zip(batch["qid"], batch["posdocid"], scores):
-                    # Need to use float16 because pytrec_eval's c function call crashes with higher precision floats
-                    preds.setdefault(qid, {})[docid] = score.astype(np.float16).item()
+                # Need to use float16 because pytrec_eval's c function call crashes with higher precision floats
+                score_chunks.append(scores.view(-1).cpu().numpy().astype(np.float16))
+                qids.extend(batch["qid"])
+                docids.extend(batch["posdocid"])
 
+        scores = np.concatenate(score_chunks) if score_chunks else np.zeros(0, dtype=np.float16)
         os.makedirs(os.path.dirname(pred_fn), exist_ok=True)
-        Searcher.write_trec_run(preds, pred_fn)
+        Searcher.write_trec_run_columnar(qids, docids, scores, pred_fn)
+
+        # pytrec_eval (and our callers) expect a dict of dicts
+        preds = {}
+        for qid, docid, score in zip(qids, docids, scores.tolist()):
+            preds.setdefault(qid, {})[docid] = score
 
         return preds
@@ -0,0 +1,289 @@
+import random
+
+import numpy as np
+import pytest
+import torch
+import torch.utils.data
+from pathlib import Path
+
+from capreolus.reranker import Reranker
+from capreolus.searcher import Searcher
+from capreolus import trainer as trainer_module
+from capreolus.trainer import PytorchTrainer
+
+
+class RecordingReranker(Reranker):
+    """ A tiny reranker that records the posdocids of the training instances it scores """
+
+    name = "test_recording"
+
+    def build(self):
+        self.model = torch.nn.Sequential(torch.nn.Dropout(0.5), torch.nn.Linear(1, 1))
+        self.seen = []
+
+    def score(self, d):
+        self.seen.extend(d["posdocid"])
+        return [self.model(d["pos"]).view(-1), self.model(d["neg"]).view(-1)]
+
+    def test(self, d):
+        return self.model(d["pos"]).view(-1)
+
+
+class RandomPairDataset(torch.utils.data.IterableDataset):
+    """ Samples training pairs with the global random module, like TrainDataset """
+
+    def __iter__(self):
+        while True:
+            posdocid, negdocid = random.randrange(1000), random.randrange(1000)
+            yield {
+                "qid": "301",
+                "posdocid": str(posdocid),
+                "negdocid": str(negdocid),
+                "pos": torch.tensor([posdocid / 1000], dtype=torch.float),
+                "neg": torch.tensor([negdocid / 1000], dtype=torch.float),
+            }
+
+
+class FixedPredDataset(torch.utils.data.IterableDataset):
+    def __iter__(self):
+        for docid in range(3):
+            yield {"qid": "301", "posdocid": str(docid), "pos": torch.tensor([docid / 3], dtype=torch.float)}
+
+
+def assert_weights_equal(fn1, fn2):
+    weights1, weights2 = torch.load(fn1), torch.load(fn2)
+    assert weights1.keys() == weights2.keys()
+    assert all(torch.equal(weights1[k], weights2[k]) for k in weights1)
+
+
+def trainer_config(**kwargs):
+    cfg = {
+        "_name": "pytorch",
+        "maxdoclen": 800,
+        "maxqlen": 4,
+        "batch": 4,
+        "niters": 2,
+        "itersize": 16,
+        "gradacc": 1,
+        "lr": 0.1,
+        "dropoutrate": 0,
+        "softmaxloss": False,
+        "amp": False,
+        "tf32": False,
+        "interactive": False,
+        "numworkers": 0,
+        "cudnnbenchmark": True,
+    }
+    cfg.update(kwargs)
+    return cfg
+
+
+def test_load_loss_file(tmpdir):
+    trainer = PytorchTrainer({"_name": "pytorch"})
+    loss_fn = Path(tmpdir) / "loss.npy"
+
+    trainer.write_loss_file(loss_fn, [])
+    assert trainer.load_loss_file(loss_fn) == []
+
+    trainer.write_loss_file(loss_fn, [1.5, 0.25, 0.125])
+    assert trainer.load_loss_file(loss_fn) == [1.5, 0.25, 0.125]
+
+
+def test_load_legacy_loss_file(tmpdir):
+    trainer = PytorchTrainer({"_name": "pytorch"})
+    loss_fn = Path(tmpdir) / "loss.npy"
+    legacy_fn = Path(tmpdir) / "loss.txt"
+
+    # loss.txt is read when loss.npy is missing
+    legacy_fn.write_text("")
+    assert trainer.load_loss_file(loss_fn) == []
+
+    legacy_fn.write_text("0 1.5\n1 0.25\n2 0.125")
+    assert trainer.load_loss_file(loss_fn) == [1.5, 0.25, 0.125]
+
+    # iterations out of order
+    legacy_fn.write_text("0 1.5\n2 0.25\n")
+    with pytest.raises(IOError):
+        trainer.load_loss_file(loss_fn)
+
+    # unparseable line
+    legacy_fn.write_text("0 1.5\n1 0.25 0.125\n")
+    with pytest.raises(IOError):
+        trainer.load_loss_file(loss_fn)
+
+    # loss.npy takes precedence once it has been written, and the migrated loss.txt is removed
+    legacy_fn.write_text("0 1.5\n1 0.25\n2 0.125")
+    trainer.write_loss_file(loss_fn, [2.0])
+    assert not legacy_fn.exists()
+    assert trainer.load_loss_file(loss_fn) == [2.0]
+
+
+@pytest.mark.parametrize("numworkers", [0, 2])
+def test_resumed_training_matches_uninterrupted_training(tmpdir, numworkers):
+    qrels = {"301": {"0": 0, "1": 1, "2": 0}}
+
+    def train(trainer, reranker, output_path):
+        trainer.train(reranker, RandomPairDataset(), output_path / "train", FixedPredDataset(), output_path / "dev", qrels, "map")
+
+    # train for two iterations without interruption
+    random.seed(123)
+    torch.manual_seed(123)
+    uninterrupted_path = Path(tmpdir) / "uninterrupted"
+    uninterrupted = RecordingReranker({"_name": "test_recording"})
+    uninterrupted.build()
+    train(PytorchTrainer(trainer_config(niters=2, numworkers=numworkers)), uninterrupted, uninterrupted_path)
+
+    # train for one iteration, then resume with fresh modules and different RNG states (as in a new process)
+    random.seed(123)
+    torch.manual_seed(123)
+    resumed_path = Path(tmpdir) / "resumed"
+    interrupted = RecordingReranker({"_name": "test_recording"})
+    interrupted.build()
+    train(PytorchTrainer(trainer_config(niters=1, numworkers=numworkers)), interrupted, resumed_path)
+
+    random.seed(456)
+    torch.manual_seed(456)
+    resumed = RecordingReranker({"_name": "test_recording"})
+    resumed.build()
+    train(PytorchTrainer(trainer_config(niters=2, numworkers=numworkers)), resumed, resumed_path)
+
+    itersize = trainer_config()["itersize"]
+    assert interrupted.seen == uninterrupted.seen[:itersize]
+    assert resumed.seen == uninterrupted.seen[itersize:]
+
+    uninterrupted_state, resumed_state = uninterrupted.model.state_dict(), resumed.model.state_dict()
+    assert all(torch.equal(uninterrupted_state[k], resumed_state[k]) for k in uninterrupted_state)
+    assert np.array_equal(
+        np.load(uninterrupted_path / "train" / "info" / "loss.npy"), np.load(resumed_path / "train" / "info" / "loss.npy")
+    )
+
+
+def test_module_path_includes_amp_only_when_enabled():
+    assert "amp-" not in PytorchTrainer(trainer_config(amp=False)).get_module_path()
+    assert "_amp-True_" in PytorchTrainer(trainer_config(amp=True)).get_module_path()
+
+
+def test_module_path_excludes_backend_options():
+    # the default config's path matches the path of results produced before these options existed
+    legacy_path = (
+        "trainer-pytorch_batch-4_dropoutrate-0_gradacc-1_interactive-False_itersize-16_lr-0.1_maxdoclen-800_maxqlen-4"
+        "_softmaxloss-False"
+    )
+    assert PytorchTrainer(trainer_config()).get_module_path() == legacy_path
+
+    for cudnnbenchmark in [True, False]:
+        for numworkers in [0, 2]:
+            cfg = trainer_config(cudnnbenchmark=cudnnbenchmark, numworkers=numworkers)
+            assert PytorchTrainer(cfg).get_module_path() == legacy_path
+
+    # tf32 changes the model's numerics, so enabling it moves the results (like amp)
+    assert PytorchTrainer(trainer_config(tf32=True)).get_module_path() == legacy_path + "_tf32-True"
+
+
+def test_dev_best_is_written_every_iteration(tmpdir, monkeypatch):
+    qrels = {"301": {"0": 0, "1": 1, "2": 0}}
+    # the first iteration ranks the relevant document first and later iterations do not
+    dev_preds = [{"301": {"1": 3.0, "0": 2.0, "2": 1.0}}, {"301": {"0": 3.0, "2": 2.0, "1": 1.0}}]
+
+    def train(niters):
+        trainer = PytorchTrainer(trainer_config(niters=niters))
+
+        def predict(reranker, pred_data, pred_fn, pred_dataloader=None):
+            preds = dev_preds[int(pred_fn.stem)]
+            Searcher.write_trec_run(preds, pred_fn)
+            return preds
+
+        monkeypatch.setattr(trainer, "predict", predict)
+        reranker = RecordingReranker({"_name": "test_recording"})
+        reranker.build()
+        trainer.train(reranker, RandomPairDataset(), train_path, FixedPredDataset(), dev_path, qrels, "map")
+
+    # dev.best holds the last iteration's weights, even though the dev metric did not improve
+    train_path, dev_path = Path(tmpdir) / "uninterrupted" / "train", Path(tmpdir) / "uninterrupted" / "dev"
+    train(niters=2)
+    assert_weights_equal(train_path / "dev.best", train_path / "weights" / "1.p")
+
+    train_path, dev_path = Path(tmpdir) / "resumed" / "train", Path(tmpdir) / "resumed" / "dev"
+    train(niters=1)
+    train(niters=2)
+    assert_weights_equal(train_path / "dev.best", train_path / "weights" / "1.p")
+
+
+def test_resume_rewrites_dev_best_after_unfinished_evaluation(tmpdir, monkeypatch):
+    qrels = {"301": {"0": 0, "1": 1, "2": 0}}
+    train_path, dev_path = Path(tmpdir) / "train", Path(tmpdir) / "dev"
+
+    # simulate the process being killed after iteration 1 is recorded in the loss file, but before its evaluation
+    # writes dev.best
+    eval_runs = trainer_module.evaluator.eval_runs
+    calls = []
+
+    def interrupted_eval_runs(*args, **kwargs):
+        calls.append(None)
+        if len(calls) == 2:
+            raise KeyboardInterrupt()
+        return eval_runs(*args, **kwargs)
+
+    monkeypatch.setattr(trainer_module.evaluator, "eval_runs", interrupted_eval_runs)
+    reranker = RecordingReranker({"_name": "test_recording"})
+    reranker.build()
+    with pytest.raises(KeyboardInterrupt):
+        PytorchTrainer(trainer_config(niters=2)).train(
+            reranker, RandomPairDataset(), train_path, FixedPredDataset(), dev_path, qrels, "map"
+        )
+    assert len(np.load(train_path / "info" / "loss.npy")) == 2
+    assert_weights_equal(train_path / "dev.best", train_path / "weights" / "0.p")
+    monkeypatch.undo()
+
+    # resuming finds no iterations left to train, but still brings dev.best up to date
+    reranker = RecordingReranker({"_name": "test_recording"})
+    reranker.build()
+    PytorchTrainer(trainer_config(niters=2)).train(
+        reranker, RandomPairDataset(), train_path, FixedPredDataset(), dev_path, qrels, "map"
+    )
+    assert_weights_equal(train_path / "dev.best", train_path / "weights" / "1.p")
+
+
+def test_load_best_model_after_rebuilding_model(tmpdir):
+    qrels = {"301": {"0": 0, "1": 1, "2": 0}}
+    train_path, dev_path = Path(tmpdir) / "train", Path(tmpdir) / "dev"
+    trainer = PytorchTrainer(trainer_config(niters=1))
+    reranker = RecordingReranker({"_name": "test_recording"})
+    reranker.build()
+    trainer.train(reranker, RandomPairDataset(), train_path, FixedPredDataset(), dev_path, qrels, "map")
+    trained_state = {k: v.clone() for k, v in reranker.model.state_dict().items()}
+
+    # the optimizer created by train must not be reused for the rebuilt model's parameters
+    reranker.build()
+    trainer.load_best_model(reranker, train_path)
+    optimizer_params = [param for group in trainer.optimizer.param_groups for param in group["params"]]
+    assert len(optimizer_params) == len(list(reranker.model.parameters()))
+    assert all(a is b for a, b in zip(optimizer_params, reranker.model.parameters()))
+
+    loaded_state = reranker.model.state_dict()
+    assert all(torch.equal(trained_state[k], loaded_state[k]) for k in trained_state)
+
+
+def test_train_finishes_writing_weights_when_predict_fails(tmpdir, monkeypatch):
+    qrels = {"301": {"0": 0, "1": 1, "2": 0}}
+    train_path, dev_path = Path(tmpdir) / "train", Path(tmpdir) / "dev"
+    trainer = PytorchTrainer(trainer_config(niters=2))
+    predict = trainer.predict
+
+    def failing_predict(reranker, pred_data, pred_fn, pred_dataloader=None):
+        if pred_fn.stem == "1":
+            raise RuntimeError("predict failed")
+        return predict(reranker, pred_data, pred_fn, pred_dataloader=pred_dataloader)
+
+    monkeypatch.setattr(trainer, "predict", failing_predict)
+    reranker = RecordingReranker({"_name": "test_recording"})
+    reranker.build()
+    with pytest.raises(RuntimeError, match="predict failed"):
+        trainer.train(reranker, RandomPairDataset(), train_path, FixedPredDataset(), dev_path, qrels, "map")
+
+    # the weights from both iterations were completely written (and replaced their temporary files)
+    for niter in range(2):
+        assert torch.load(train_path / "weights" / f"{niter}.p").keys() == reranker.model.state_dict().keys()
+        assert (train_path / "weights" / f"{niter}.p.optimizer").exists()
+    assert (train_path / "dev.best").exists()
+    assert not list(train_path.glob("**/*.tmp"))